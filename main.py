@@ -3,38 +3,138 @@ import ollama
 import json
 import os
 import re
+import asyncio
+import atexit
 import datetime
-import random
-from typing import List, Dict, Any, Optional, Tuple
+import functools
+import hashlib
+import queue
+import threading
+import time
+import uuid
+import numpy as np
+from enum import IntEnum
+from typing import List, Dict, Any, Optional, Tuple, Iterator, Union, Callable, Awaitable
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from dateparser.date import DateDataParser
+except ImportError:
+    DateDataParser = None
+
+_json_loads = orjson.loads if orjson else json.loads
+
+# Compact JSON text for embedding data in prompts
+def _json_dumps(obj) -> str:
+    return orjson.dumps(obj).decode() if orjson else json.dumps(obj, ensure_ascii=False)
 
 # Configuration
 MODEL_NAME = "llama3.1:8b"
 DATABASE_FILE = "restaurants_db.json"
+LLM_CACHE_SIZE = 512
+EMBEDDING_MODEL = "nomic-embed-text"
+SEMANTIC_CACHE_THRESHOLD = 0.92
+OLLAMA_KEEP_ALIVE = "30m"
+# Context window set explicitly on every request. Ollama's default differs between versions, and
+# changing num_ctx between calls makes it reload the model, so every call uses this one value.
+OLLAMA_NUM_CTX = 8192
+# Longest streamed reply, so a saved context only gets reused when the reply still fits after it
+PROSE_NUM_PREDICT = 768
+PAIRED_HISTORY_LIMIT = 20
+# Upper bound on state transitions in one turn, so a cycle between silent states can't loop forever
+MAX_STATE_TRANSITIONS = 10
+# Reservations are saved in batches of up to this many, or after this many seconds
+RESERVATION_BATCH_SIZE = 32
+RESERVATION_FLUSH_INTERVAL = 0.5
+
+# How reservation times are shown to the user
+DATETIME_DISPLAY_FORMAT = "%A, %B %d at %I:%M %p"
+
+# Structured extractors only need a short, deterministic answer
+EXTRACTOR_OPTIONS = {"temperature": 0, "top_p": 1, "num_predict": 64}
+
+# Shared persona prompt for all of Alfred's prose replies. It stays identical between calls so
+# Ollama can reuse the cached prefix; the task instructions go in the user prompt instead.
+ALFRED_SYSTEM_PROMPT = """
+    You are Alfred, a friendly AI assistant for a restaurant booking system in Bengaluru.
+    Respond to the user in a helpful, concise, and conversational way.
+    
+    IMPORTANT: DO NOT claim or imply that you have more restaurants than the number in the database.
+    Only reference the actual number of available restaurants.
+    """
+
+# Database summary appended to system prompts
+DATA_METADATA_TEMPLATE = """
+        IMPORTANT: You have access to exactly {n} restaurants in the database.
+        Available cuisines: {cuisines}
+        Available locations: {locations}
+        Available price ranges: {price_ranges}
+        """
+
+# Fixed replies shared by the state handlers
+_RESP_ASK_NAME = "Under what name should I make the reservation?"
+_RESP_GREETING = "Hello! I'm Alfred, your Bengaluru restaurant assistant. I can help you find restaurants and make reservations. What are you looking for today?"
+_RESP_FALLBACK = "I'm not sure what you're looking for. Would you like to search for restaurants or make a reservation?"
+_RESP_START_BOOKING = "Great! Let's make a reservation. " + _RESP_ASK_NAME
+_RESP_FIND_FIRST = "I'd be happy to help you make a reservation. First, let's find a restaurant. Do you have any preferences for cuisine, location, or price range?"
+_RESP_WHICH_DETAILS = "I'd be happy to provide details about a restaurant. Which restaurant are you interested in?"
+_RESP_WHICH_BOOKING = "Which of these restaurants would you like to make a reservation for? Please specify the restaurant name clearly."
+_RESP_BOOK_FROM_DETAILS = "Great! I'd be happy to make a reservation for you. " + _RESP_ASK_NAME
+_RESP_CONFIRMING = "Thank you for confirming. I'm processing your reservation now..."
+_RESP_NOT_CONFIRMED = "Let's try again. " + _RESP_ASK_NAME
+_RESP_ERROR = "I'm sorry, there was an error processing your reservation. Would you like to try again or speak with customer support?"
+_RESP_SAVE_ERROR = "I'm sorry, there was an error saving your reservation at {restaurant} for {datetime_str}. Would you like to try again or speak with customer support?"
+_RESP_TRY_AGAIN = "Let's try making your reservation again. " + _RESP_ASK_NAME
+_RESP_SUPPORT = "I'll connect you with customer support. Please call +91 80 12345678 during business hours (9 AM - 6 PM) for assistance with your reservation."
+_RESP_SUPPORT_FOLLOW_UP = "Our customer support team is available to help you. Is there anything else I can assist you with?"
+_RESP_THANK_YOU = "Thank you for using Alfred! Your reservation has been confirmed. Is there anything else you would like assistance with?"
+
+# Streamlit re-executes this script on every rerun, so anything that must outlive a single run is
+# created through st.cache_resource, which hands back the same object on every rerun and session.
+
+# Exact-match cache of LLM responses, keyed by a digest of the full request
+@st.cache_resource
+def _get_llm_cache() -> Dict[str, str]:
+    return {}
 
-# States for conversation flow
-class State:
-    GREETING = "Greeting"
-    INTENT_DETECTION = "IntentDetection"
-    FIND_RESTAURANT = "FindRestaurant"
-    RESTAURANT_SUGGESTION = "RestaurantSuggestion"
-    RESTAURANT_DETAILS = "RestaurantDetails"
-    MAKE_RESERVATION = "MakeReservation"
-    DATA_COLLECTION = "DataCollection"
-    NAME_PROMPT = "NamePrompt"
-    NAME_RECEIVED = "NameReceived"
-    DATETIME_PROMPT = "DateTimePrompt"
-    DATETIME_RECEIVED = "DateTimeReceived"
-    PARTY_PROMPT = "PartyPrompt"
-    PARTY_RECEIVED = "PartyReceived"
-    CONFIRM_RESERVATION = "ConfirmReservation"
-    RESERVATION_CONFIRMED = "ReservationConfirmed"
-    DATABASE_PUSH = "DatabasePush"
-    RESERVATION_SUCCESS = "ReservationSuccess"
-    ERROR_HANDLING = "ErrorHandling"
-    RESERVATION_RETRY = "ReservationRetry"
-    SUPPORT = "Support"
-    THANK_YOU = "ThankYou"
-    NORMAL_CONVERSATION = "NormalConversation"
+# Sessions run on separate threads, so updates to the shared LLM cache go through this lock
+@st.cache_resource
+def _get_llm_cache_lock() -> threading.Lock:
+    return threading.Lock()
+
+_llm_cache = _get_llm_cache()
+_llm_cache_lock = _get_llm_cache_lock()
+
+# States for conversation flow. Integer values keep comparisons and handler lookups cheap, and
+# since IntEnum members compare by value, states saved in session state still match after a rerun
+# redefines the class. Values start at 1 so every state is truthy.
+class State(IntEnum):
+    GREETING = 1
+    INTENT_DETECTION = 2
+    FIND_RESTAURANT = 3
+    RESTAURANT_SUGGESTION = 4
+    RESTAURANT_DETAILS = 5
+    MAKE_RESERVATION = 6
+    DATA_COLLECTION = 7
+    NAME_PROMPT = 8
+    NAME_RECEIVED = 9
+    DATETIME_PROMPT = 10
+    DATETIME_RECEIVED = 11
+    PARTY_PROMPT = 12
+    PARTY_RECEIVED = 13
+    CONFIRM_RESERVATION = 14
+    RESERVATION_CONFIRMED = 15
+    DATABASE_PUSH = 16
+    RESERVATION_SUCCESS = 17
+    ERROR_HANDLING = 18
+    RESERVATION_RETRY = 19
+    SUPPORT = 20
+    THANK_YOU = 21
+    NORMAL_CONVERSATION = 22
 
 # Create restaurants database if it doesn't exist
 def create_database():
@@ -76,97 +176,473 @@ def create_database():
         "Monsoon Masala", "Mango Mantra", "Windmill Wok", "Bamboo Bytes"
     ]
     
-    # Generate 20 restaurants with varied attributes
-    restaurants = []
-    for i in range(20):
-        restaurant = {
+    # Generate 20 restaurants with varied attributes, drawing every random field in one batch
+    n = len(names)
+    rng = np.random.default_rng()
+    cuisine_idx = rng.integers(0, len(cuisines), n).tolist()
+    location_idx = rng.integers(0, len(areas), n).tolist()
+    price_idx = rng.integers(0, len(price_ranges), n).tolist()
+    ratings = np.round(rng.uniform(3.5, 4.9, n), 1).tolist()
+    # A random permutation per row; the first seat_counts[i] entries are a sample without replacement
+    seating_perm = rng.random((n, len(seating_options))).argsort(axis=1).tolist()
+    seat_counts = rng.integers(2, 6, n).tolist()
+    capacities = rng.integers(20, 201, n).tolist()
+    open_hours = rng.integers(8, 13, (n, 2)).tolist()
+    close_hours = rng.integers(9, 12, (n, 2)).tolist()
+    street_numbers = rng.integers(1, 101, n).tolist()
+    street_types = ['Main', 'Cross', 'Avenue', 'Street']
+    street_idx = rng.integers(0, len(street_types), n).tolist()
+    address_area_idx = rng.integers(0, len(areas), n).tolist()
+    contacts = rng.integers(6000000000, 10000000000, n).tolist()
+    
+    restaurants = [
+        {
             "id": i + 1,
             "name": names[i],
-            "cuisine": random.choice(cuisines),
-            "location": random.choice(areas),
-            "price_range": random.choice(price_ranges),
-            "rating": round(random.uniform(3.5, 4.9), 1),
-            "seating_arrangements": random.sample(seating_options, random.randint(2, 5)),
-            "capacity": random.randint(20, 200),
+            "cuisine": cuisines[cuisine_idx[i]],
+            "location": areas[location_idx[i]],
+            "price_range": price_ranges[price_idx[i]],
+            "rating": ratings[i],
+            "seating_arrangements": [seating_options[j] for j in seating_perm[i][:seat_counts[i]]],
+            "capacity": capacities[i],
             "opening_hours": {
-                "weekdays": f"{random.randint(8, 12)}:00 AM - {random.randint(9, 11)}:00 PM",
-                "weekends": f"{random.randint(8, 12)}:00 AM - {random.randint(9, 11)}:00 PM"
+                "weekdays": f"{open_hours[i][0]}:00 AM - {close_hours[i][0]}:00 PM",
+                "weekends": f"{open_hours[i][1]}:00 AM - {close_hours[i][1]}:00 PM"
             },
             "specialties": [f"Signature dish {i+1}", f"Special drink {i+1}"],
-            "address": f"{random.randint(1, 100)}, {random.choice(['Main', 'Cross', 'Avenue', 'Street'])}, {random.choice(areas)}, Bengaluru",
-            "contact": f"+91 {random.randint(6000000000, 9999999999)}",
+            "address": f"{street_numbers[i]}, {street_types[street_idx[i]]}, {areas[address_area_idx[i]]}, Bengaluru",
+            "contact": f"+91 {contacts[i]}",
             "reservations": []
         }
-        restaurants.append(restaurant)
+        for i in range(n)
+    ]
     
     # Save to JSON file
-    with open(DATABASE_FILE, "w") as f:
-        json.dump(restaurants, f, indent=4)
+    save_database(restaurants)
 
 # Load restaurants database
 def load_database():
-    with open(DATABASE_FILE, "r") as f:
+    if orjson:
+        with open(DATABASE_FILE, "rb") as f:
+            return orjson.loads(f.read())
+    with open(DATABASE_FILE, "r", encoding="utf-8") as f:
         return json.load(f)
 
-# Save restaurants database
+# Save restaurants database (written to a temp file first so a crash never leaves a torn file)
 def save_database(restaurants):
-    with open(DATABASE_FILE, "w") as f:
-        json.dump(restaurants, f, indent=4)
+    tmp_file = DATABASE_FILE + ".tmp"
+    if orjson:
+        with open(tmp_file, "wb") as f:
+            f.write(orjson.dumps(restaurants, option=orjson.OPT_INDENT_2))
+    else:
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(restaurants, f, indent=4)
+    os.replace(tmp_file, DATABASE_FILE)
 
-# Get response from Llama 3.1 model with database metadata
-def get_llm_response(prompt: str, system_prompt: str = None, restaurants_data: dict = None) -> str:
-    # Create a data-aware system prompt with accurate restaurant count
-    if restaurants_data:
-        data_metadata = f"""
-        IMPORTANT: You have access to exactly {len(restaurants_data)} restaurants in the database.
-        Available cuisines: {', '.join(set(r['cuisine'] for r in restaurants_data))}
-        Available locations: {', '.join(set(r['location'] for r in restaurants_data))}
-        Available price ranges: {', '.join(set(r['price_range'] for r in restaurants_data))}
-        """
+# Summarize the database for LLM prompts
+def build_database_metadata(restaurants):
+    return {
+        "n": len(restaurants),
+        "cuisines": ", ".join(sorted({r['cuisine'] for r in restaurants})),
+        "locations": ", ".join(sorted({r['location'] for r in restaurants})),
+        "price_ranges": ", ".join(sorted({r['price_range'] for r in restaurants}))
+    }
+
+# Build lowercase column arrays of the searchable fields, one entry per restaurant
+def build_search_index(restaurants):
+    return {
+        "cuisine": np.array([r['cuisine'].lower() for r in restaurants], dtype=str),
+        "location": np.array([r['location'].lower() for r in restaurants], dtype=str),
+        "address": np.array([r['address'].lower() for r in restaurants], dtype=str),
+        "price_range": np.array([r['price_range'].lower() for r in restaurants], dtype=str),
+        # All seating options joined so one substring search covers every option
+        "seating": np.array(["|".join(r['seating_arrangements']).lower() for r in restaurants], dtype=str),
+        "rating": np.array([r['rating'] for r in restaurants], dtype=float)
+    }
+
+# Index restaurants by id; the values are the same dicts as in the list
+def build_restaurants_by_id(restaurants):
+    return {r['id']: r for r in restaurants}
+
+# Build the lowercase word set of every restaurant name, keyed by restaurant id
+def build_name_tokens(restaurants):
+    return {r['id']: set(_TOKEN_RE.findall(r['name'].lower())) for r in restaurants}
+
+# Build the set of lowercase search values the database knows (cuisines, locations, prices, seating)
+def build_search_terms(restaurants):
+    terms = set()
+    for r in restaurants:
+        terms.update((r['cuisine'].lower(), r['location'].lower(), r['price_range'].lower()))
+        terms.update(s.lower() for s in r['seating_arrangements'])
+    return frozenset(terms)
+
+# Get restaurants database, re-reading the file only when it has changed on disk
+def get_restaurants():
+    mtime = os.path.getmtime(DATABASE_FILE)
+    if st.session_state.get('_db_mtime') != mtime or '_db_cache' not in st.session_state:
+        st.session_state._db_cache = load_database()
+        st.session_state._db_meta = build_database_metadata(st.session_state._db_cache)
+        st.session_state._db_index = build_search_index(st.session_state._db_cache)
+        st.session_state._db_name_tokens = build_name_tokens(st.session_state._db_cache)
+        st.session_state._db_by_id = build_restaurants_by_id(st.session_state._db_cache)
+        st.session_state._db_search_terms = build_search_terms(st.session_state._db_cache)
+        st.session_state._db_mtime = mtime
+    return st.session_state._db_cache
+
+# Reuse a structure derived from the loaded database, or build it for any other restaurants list
+def _derived_from_database(restaurants, key, build):
+    if restaurants is st.session_state.get('_db_cache') and key in st.session_state:
+        return st.session_state[key]
+    return build(restaurants)
+
+# Get the prompt metadata for a restaurants list
+def get_database_metadata(restaurants):
+    return _derived_from_database(restaurants, '_db_meta', build_database_metadata)
+
+# Get the search index for a restaurants list
+def get_search_index(restaurants):
+    return _derived_from_database(restaurants, '_db_index', build_search_index)
+
+# Get the restaurant name word sets for a restaurants list
+def get_name_tokens(restaurants):
+    return _derived_from_database(restaurants, '_db_name_tokens', build_name_tokens)
+
+# Get the known search values for a restaurants list
+def get_search_terms(restaurants):
+    return _derived_from_database(restaurants, '_db_search_terms', build_search_terms)
+
+# Get the id -> restaurant index for a restaurants list
+def get_restaurants_by_id(restaurants):
+    return _derived_from_database(restaurants, '_db_by_id', build_restaurants_by_id)
+
+# Build the cache key for an LLM request
+def _llm_cache_key(prompt: str, system_prompt: Optional[str], metadata: Optional[Dict[str, Any]], format: Optional[str] = None, options: Optional[Dict[str, Any]] = None) -> str:
+    payload = json.dumps({
+        "m": MODEL_NAME,
+        "s": system_prompt,
+        "u": prompt,
+        "n": metadata["n"] if metadata else 0,
+        "f": format,
+        "o": options
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+# Words in a restaurant name or user message
+_TOKEN_RE = re.compile(r'\w+')
+# Keyword triggers for the yes/no style states, matched against whole words of the input
+CONFIRM_TRIGGERS = frozenset({"yes", "correct", "confirm", "confirmed"})
+TRY_TRIGGERS = frozenset({"try", "again", "retry"})
+
+# Lowercased input and its word set. A turn passes the same input through several handlers,
+# so the most recent result is kept and the text is only lowered and split once per turn.
+@functools.lru_cache(maxsize=1)
+def _normalize_input(user_input: str) -> Tuple[str, frozenset]:
+    text = user_input.lower()
+    return text, frozenset(_TOKEN_RE.findall(text))
+
+# Shared name words needed to accept a match without the full name ("the spice garden place")
+NAME_MATCH_MIN_TOKENS = 2
+
+# Fast paths for reading party sizes and date/times without calling the LLM
+_NUM_RE = re.compile(r'\b(\d{1,3})\b')
+_WORD2NUM = {
+    "one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6,
+    "seven": 7, "eight": 8, "nine": 9, "ten": 10, "eleven": 11, "twelve": 12
+}
+_WORD_RE = re.compile(r'\b(' + '|'.join(_WORD2NUM) + r')\b', re.IGNORECASE)
+# The local date parser is only trusted with a relative day or weekday plus one time of day
+# ("tomorrow at 7 PM", "friday 8pm"); it misreads forms like "on the 5th at 19:30" as other months
+_SIMPLE_DATE_WORDS = frozenset({
+    "today", "tomorrow", "day", "after", "on", "at", "am", "pm",
+    "monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"
+})
+_TIME_TOKEN_RE = re.compile(r'(?i)^\d{1,2}(?::\d{2})?(?:am|pm)?$')
+# RETURN_TIME_AS_PERIOD reports period "time" only when the input included a time of day
+@st.cache_resource
+def _get_date_parser():
+    if not DateDataParser:
+        return None
+    return DateDataParser(languages=['en'], settings={
+        'PREFER_DATES_FROM': 'future',
+        'RETURN_TIME_AS_PERIOD': True
+    })
+
+_date_parser = _get_date_parser()
+
+# Keyword classifier for clearly worded requests, checked before asking the LLM
+_INTENT_RE = re.compile(
+    r'(?i)\b(?P<book>book\w*|reserv\w*)\b'
+    r'|\b(?P<search>find|search|show|suggest\w*)\b'
+    r'|\b(?P<details>details?|info|information|tell me about|tell me more)\b'
+)
+# Booking wins over details, and details over search ("show me details")
+_INTENT_PRIORITY = [("book", "reservation"), ("details", "details"), ("search", "restaurant_search")]
+
+# Return the intent named by keywords in the input, or None if there are none
+def classify_intent(user_input: str) -> Optional[str]:
+    found = {m.lastgroup for m in _INTENT_RE.finditer(user_input)}
+    for group, intent in _INTENT_PRIORITY:
+        if group in found:
+            return intent
+    return None
+
+# Similarity cache for structured outputs, so paraphrased inputs reuse an earlier result
+class SemanticCache:
+    def __init__(self, threshold: float = SEMANTIC_CACHE_THRESHOLD, max_entries: int = 256):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        # scope -> (matrix of L2-normalized embeddings, parallel list of (prompt, response))
+        self._entries: Dict[Tuple, Tuple[np.ndarray, List[Tuple[str, Any]]]] = {}
+        # Shared by every session thread; put() replaces a scope's entry under the lock
+        self._lock = threading.Lock()
+    
+    # Non-blocking embed for coroutines, so concurrent requests don't wait on each other's embedding
+    async def aembed(self, client: ollama.AsyncClient, text: str) -> Optional[np.ndarray]:
+        try:
+            return self._normalize((await client.embeddings(model=EMBEDDING_MODEL, prompt=text))["embedding"])
+        except Exception:
+            # Embedding model unavailable, skip the cache
+            return None
+    
+    @staticmethod
+    def _normalize(values) -> Optional[np.ndarray]:
+        vector = np.asarray(values, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else None
+    
+    def get(self, scope: Tuple, embedding: Optional[np.ndarray]) -> Optional[Any]:
+        entry = self._entries.get(scope) if embedding is not None else None
+        if entry is None:
+            return None
+        matrix, items = entry
+        scores = matrix @ embedding
+        best = int(np.argmax(scores))
+        if scores[best] >= self.threshold:
+            return items[best][1]
+        return None
+    
+    def put(self, scope: Tuple, embedding: Optional[np.ndarray], prompt: str, response: Any):
+        if embedding is None:
+            return
+        with self._lock:
+            if scope in self._entries:
+                matrix, items = self._entries[scope]
+                matrix = np.vstack([matrix, embedding])[-self.max_entries:]
+                items = (items + [(prompt, response)])[-self.max_entries:]
+            else:
+                matrix, items = embedding[np.newaxis, :], [(prompt, response)]
+            self._entries[scope] = (matrix, items)
+
+@st.cache_resource
+def _get_semantic_cache(name: str) -> SemanticCache:
+    return SemanticCache()
+
+_intent_cache = _get_semantic_cache("intent")
+_search_params_cache = _get_semantic_cache("search_params")
+
+# Conversation context a cached answer is valid for (e.g. "yes" means different things per state)
+def _semantic_scope() -> Tuple:
+    return (st.session_state.get("state"), st.session_state.get("current_restaurant_id"))
+
+# Return the first complete JSON object embedded in an LLM response, or None
+def _first_json_object(text: str) -> Optional[Dict[str, Any]]:
+    start = text.find('{')
+    while start != -1:
+        # Scan for the matching closing brace, ignoring braces inside strings
+        depth = 0
+        in_string = False
+        escaped = False
+        for i in range(start, len(text)):
+            ch = text[i]
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif ch == '\\':
+                    escaped = True
+                elif ch == '"':
+                    in_string = False
+            elif ch == '"':
+                in_string = True
+            elif ch == '{':
+                depth += 1
+            elif ch == '}':
+                depth -= 1
+                if depth == 0:
+                    try:
+                        parsed = _json_loads(text[start:i + 1])
+                    except ValueError:
+                        break
+                    if isinstance(parsed, dict):
+                        return parsed
+                    break
+        start = text.find('{', start + 1)
+    return None
+
+# Store an LLM response, evicting the oldest entry once the cache is full
+def _cache_llm_response(cache_key: str, content: str):
+    with _llm_cache_lock:
+        if len(_llm_cache) >= LLM_CACHE_SIZE:
+            _llm_cache.pop(next(iter(_llm_cache)), None)
+        _llm_cache[cache_key] = content
+
+# Create a data-aware system prompt with accurate restaurant count
+def _build_system_prompt(system_prompt: Optional[str], metadata: Optional[Dict[str, Any]]) -> Optional[str]:
+    if metadata:
+        data_metadata = DATA_METADATA_TEMPLATE.format(**metadata)
         
         if system_prompt:
             system_prompt = system_prompt + "\n" + data_metadata
         else:
             system_prompt = data_metadata
-    
+    return system_prompt
+
+# Build the chat messages for a request, adding database metadata to the system prompt
+def _build_messages(prompt: str, system_prompt: Optional[str], metadata: Optional[Dict[str, Any]]) -> List[Dict[str, str]]:
+    system_prompt = _build_system_prompt(system_prompt, metadata)
+    messages = [{"role": "user", "content": prompt}]
     if system_prompt:
-        response = ollama.chat(
-            model=MODEL_NAME,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": prompt}
-            ]
-        )
-    else:
-        response = ollama.chat(
-            model=MODEL_NAME,
-            messages=[{"role": "user", "content": prompt}]
-        )
+        messages.insert(0, {"role": "system", "content": system_prompt})
+    return messages
+
+# Request options with the shared context window filled in
+def _request_options(options: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    return {"num_ctx": OLLAMA_NUM_CTX, **(options or {})}
+
+# Rough token count of text about to be sent, erring high (English averages about 4 characters a token)
+def _estimate_tokens(text: Optional[str]) -> int:
+    return len(text or "") // 3 + 1
+
+# Get response from Llama 3.1 model with database metadata
+def get_llm_response(prompt: str, system_prompt: str = None, metadata: Dict[str, Any] = None, format: str = None, options: Dict[str, Any] = None) -> str:
+    # Identical requests are answered from the cache without calling the model
+    cache_key = _llm_cache_key(prompt, system_prompt, metadata, format, options)
+    cached = _llm_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    
+    messages = _build_messages(prompt, system_prompt, metadata)
     
-    return response['message']['content']
+    # format="json" makes Ollama constrain decoding to valid JSON
+    response = ollama.chat(model=MODEL_NAME, messages=messages, format=format, options=_request_options(options), keep_alive=OLLAMA_KEEP_ALIVE)
+    
+    content = response['message']['content']
+    _cache_llm_response(cache_key, content)
+    return content
+
+# Async variant of get_llm_response, so independent requests can be in flight at the same time
+async def aget_llm_response(client: ollama.AsyncClient, prompt: str, system_prompt: str = None, metadata: Dict[str, Any] = None, format: str = None, options: Dict[str, Any] = None) -> str:
+    cache_key = _llm_cache_key(prompt, system_prompt, metadata, format, options)
+    cached = _llm_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    
+    messages = _build_messages(prompt, system_prompt, metadata)
+    response = await client.chat(model=MODEL_NAME, messages=messages, format=format, options=_request_options(options), keep_alive=OLLAMA_KEEP_ALIVE)
+    
+    content = response['message']['content']
+    _cache_llm_response(cache_key, content)
+    return content
+
+# Stream the response from the model chunk by chunk, so long replies render while they are generated.
+# With a context_role, the Ollama context from that role's previous call is passed back in so the
+# shared system prompt prefix is not processed again.
+def stream_llm_response(prompt: str, system_prompt: str = None, metadata: Dict[str, Any] = None, context_role: str = None) -> Iterator[str]:
+    cache_key = _llm_cache_key(prompt, system_prompt, metadata)
+    cached = _llm_cache.get(cache_key)
+    if cached is not None:
+        yield cached
+        return
+    
+    system = _build_system_prompt(system_prompt, metadata)
+    contexts = st.session_state.setdefault('ollama_ctx', {})
+    context = contexts.get(context_role) if context_role else None
+    # Start over unless the saved context, this prompt and the longest reply all fit in the window;
+    # otherwise Ollama would silently truncate the context
+    if context and len(context) + _estimate_tokens(system) + _estimate_tokens(prompt) + PROSE_NUM_PREDICT > OLLAMA_NUM_CTX:
+        context = None
+    
+    chunks = []
+    for chunk in ollama.generate(
+        model=MODEL_NAME,
+        system=system,
+        prompt=prompt,
+        context=context,
+        stream=True,
+        options=_request_options({"num_predict": PROSE_NUM_PREDICT}),
+        keep_alive=OLLAMA_KEEP_ALIVE
+    ):
+        text = chunk['response']
+        chunks.append(text)
+        yield text
+        
+        if chunk.get('done') and context_role:
+            contexts[context_role] = chunk.get('context') or None
+    
+    _cache_llm_response(cache_key, "".join(chunks))
+
+# Run coroutines on one event loop with a shared Ollama client, closing the client when they finish
+def _run_with_client(*tasks: Callable[[ollama.AsyncClient], Awaitable[Any]]) -> List[Any]:
+    async def run():
+        async with ollama.AsyncClient() as client:
+            return await asyncio.gather(*(task(client) for task in tasks))
+    return asyncio.run(run())
 
 # Intent detection function
 def detect_intent(user_input: str) -> str:
+    # Keywords answer without any request, so skip the client and event loop entirely
+    intent = classify_intent(user_input)
+    if intent:
+        return intent
+    return _run_with_client(lambda client: detect_intent_async(user_input, client))[0]
+
+async def detect_intent_async(user_input: str, client: ollama.AsyncClient) -> str:
     system_prompt = """
     You are an AI assistant for a restaurant booking system. Analyze the user input and determine their intent.
     Respond with exactly one of these intents: 'restaurant_search', 'reservation', 'details', 'normal_conversation'.
     Don't explain your reasoning, just respond with the intent.
     """
     
+    intent = classify_intent(user_input)
+    if intent:
+        return intent
+    
+    scope = _semantic_scope()
+    embedding = await _intent_cache.aembed(client, user_input)
+    cached = _intent_cache.get(scope, embedding)
+    if cached is not None:
+        return cached
+    
     prompt = f"Determine the intent from this user input: '{user_input}'"
-    response = get_llm_response(prompt, system_prompt).strip().lower()
+    response = (await aget_llm_response(client, prompt, system_prompt, options=EXTRACTOR_OPTIONS)).strip().lower()
     
     if 'restaurant_search' in response or 'search' in response:
-        return 'restaurant_search'
+        intent = 'restaurant_search'
     elif 'reservation' in response or 'book' in response:
-        return 'reservation'
+        intent = 'reservation'
     elif 'details' in response or 'information' in response:
-        return 'details'
+        intent = 'details'
     else:
-        return 'normal_conversation'
+        intent = 'normal_conversation'
+    
+    _intent_cache.put(scope, embedding, user_input, intent)
+    return intent
+
+# Whether cached search parameters say exactly what the input says. Inputs that differ only in the
+# entity ("Italian in Indiranagar" vs "Chinese in Indiranagar", or "Italian food" vs "Italian food
+# in Indiranagar") embed almost identically, so a paraphrase match is only reused when every cached
+# value is named in the input and every known search value in the input is among the cached ones.
+def _params_match_input(params: Dict[str, Any], user_input: str, search_terms: frozenset) -> bool:
+    text = _normalize_input(user_input)[0]
+    values = [str(value).lower() for value in params.values() if value and value != 'null']
+    if not all(value in text for value in values):
+        return False
+    return all(any(term in value or value in term for value in values) for term in search_terms if term in text)
 
 # Extract restaurant search parameters
-def extract_search_params(user_input: str) -> Dict[str, Any]:
+def extract_search_params(user_input: str, restaurants) -> Dict[str, Any]:
+    return _run_with_client(lambda client: extract_search_params_async(user_input, client, restaurants))[0]
+
+async def extract_search_params_async(user_input: str, client: ollama.AsyncClient, restaurants) -> Dict[str, Any]:
     system_prompt = """
     You are an AI assistant for a restaurant booking system. Extract search parameters from the user input.
     Output ONLY a JSON object with these fields:
@@ -179,89 +655,144 @@ def extract_search_params(user_input: str) -> Dict[str, Any]:
     Don't include any other text in your response. Only return valid JSON.
     """
     
+    scope = _semantic_scope()
+    embedding = await _search_params_cache.aembed(client, user_input)
+    cached = _search_params_cache.get(scope, embedding)
+    if cached is not None and _params_match_input(cached, user_input, get_search_terms(restaurants)):
+        return dict(cached)
+    
     prompt = f"Extract search parameters from: '{user_input}'"
-    response = get_llm_response(prompt, system_prompt)
+    response = await aget_llm_response(client, prompt, system_prompt, format="json", options=EXTRACTOR_OPTIONS)
     
-    try:
-        # Try to extract JSON from the response
-        match = re.search(r'\{.*\}', response, re.DOTALL)
-        if match:
-            json_str = match.group(0)
-            return json.loads(json_str)
-        else:
-            return {}
-    except:
+    params = _first_json_object(response)
+    if params is None:
         return {}
+    
+    # An answer with no values would match any similar-sounding input, so it isn't cached
+    if any(value and value != 'null' for value in params.values()):
+        _search_params_cache.put(scope, embedding, user_input, params)
+    return dict(params)
+
+# Detect the intent while speculatively extracting search parameters, so a search turn
+# costs one round-trip instead of two. The parameters are None when the intent is not a search.
+def detect_intent_with_search_params(user_input: str, restaurants) -> Tuple[str, Optional[Dict[str, Any]]]:
+    # Keywords already settle the intent, so there is nothing to overlap
+    intent = classify_intent(user_input)
+    if intent == 'restaurant_search':
+        return intent, extract_search_params(user_input, restaurants)
+    if intent:
+        return intent, None
+    
+    intent, params = _run_with_client(
+        lambda client: detect_intent_async(user_input, client),
+        lambda client: extract_search_params_async(user_input, client, restaurants)
+    )
+    return intent, params if intent == 'restaurant_search' else None
+
+# Lowercased search value for a parameter, or None when the user didn't give one
+def _search_query(params: Dict[str, Any], key: str) -> Optional[str]:
+    value = params.get(key)
+    if not value or value == 'null':
+        return None
+    return str(value).lower()
 
 # Find restaurants based on search parameters
 def find_restaurants(params: Dict[str, Any], restaurants: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-    filtered = restaurants.copy()
+    index = get_search_index(restaurants)
+    cuisine_query = _search_query(params, 'cuisine')
+    location_query = _search_query(params, 'location')
+    price_query = _search_query(params, 'price_range')
+    seating_query = _search_query(params, 'seating')
+    
+    # Each filter only checks the rows that passed the previous ones
+    matches = np.arange(len(restaurants))
     
-    if params.get('cuisine') and params['cuisine'] != 'null':
-        filtered = [r for r in filtered if params['cuisine'].lower() in r['cuisine'].lower()]
+    if cuisine_query:
+        matches = matches[np.char.find(index['cuisine'][matches], cuisine_query) >= 0]
     
-    # Improved location matching in find_restaurants function
-    if params.get('location') and params['location'] != 'null':
-        location_query = params['location'].lower()
-        # More flexible location matching
-        filtered = [r for r in filtered if location_query in r['location'].lower() or 
-                    location_query in r['address'].lower()]
+    # More flexible location matching: area name or street address
+    if location_query:
+        matches = matches[(np.char.find(index['location'][matches], location_query) >= 0) |
+                          (np.char.find(index['address'][matches], location_query) >= 0)]
     
-    if params.get('price_range') and params['price_range'] != 'null':
-        # Simple matching for now
-        filtered = [r for r in filtered if params['price_range'].lower() in r['price_range'].lower()]
+    # Simple matching for now
+    if price_query:
+        matches = matches[np.char.find(index['price_range'][matches], price_query) >= 0]
     
-    if params.get('seating') and params['seating'] != 'null':
-        filtered = [r for r in filtered if any(params['seating'].lower() in s.lower() for s in r['seating_arrangements'])]
+    if seating_query:
+        matches = matches[np.char.find(index['seating'][matches], seating_query) >= 0]
     
     # Return top restaurants by rating if we have too many
-    if len(filtered) > 5:
-        filtered.sort(key=lambda x: x['rating'], reverse=True)
-        return filtered[:5]
+    if len(matches) > 5:
+        top = matches[np.argsort(-index['rating'][matches], kind='stable')[:5]]
+        return [restaurants[i] for i in top]
     
     # If no results, return some recommended ones
-    if not filtered:
-        return sorted(restaurants, key=lambda x: x['rating'], reverse=True)[:3]
+    if len(matches) == 0:
+        top = np.argsort(-index['rating'], kind='stable')[:3]
+        return [restaurants[i] for i in top]
     
-    return filtered
+    return [restaurants[i] for i in matches]
 
 # Generate restaurant suggestions text
-def generate_restaurant_suggestions(restaurants: List[Dict[str, Any]], all_restaurants: List[Dict[str, Any]]) -> str:
-    system_prompt = f"""
-    You are Alfred, an AI assistant for a restaurant booking system in Bengaluru. Create an enticing and informative suggestion
-    message for these restaurants. Keep it friendly and conversational, but focused.
-    
-    IMPORTANT: You have access to exactly {len(all_restaurants)} restaurants in the database. DO NOT claim or imply
-    that you have more restaurants than this number.
-    """
+def generate_restaurant_suggestions(restaurants: List[Dict[str, Any]], all_restaurants: List[Dict[str, Any]], stream: bool = False) -> Union[str, Iterator[str]]:
+    # Only the fields the suggestion mentions, to keep the prompt short
+    slim = [{
+        "name": r["name"],
+        "cuisine": r["cuisine"],
+        "location": r["location"],
+        "price": r["price_range"],
+        "rating": r["rating"],
+        "specialty": r["specialties"][0] if r["specialties"] else None,
+        "seating": r["seating_arrangements"][0] if r["seating_arrangements"] else None
+    } for r in restaurants]
     
     prompt = f"""Based on the user's preferences, here are some restaurant options:
-    {json.dumps(restaurants, indent=2)}
+    {_json_dumps(slim)}
     
-    Generate a helpful response suggesting these restaurants. Include their name, cuisine, location, and one unique feature for each.
+    Create an enticing and informative suggestion message for these restaurants. Keep it friendly and conversational, but focused.
+    Include their name, cuisine, location, and one unique feature for each.
     Keep it concise (max 200 words).
     """
     
-    return get_llm_response(prompt, system_prompt, all_restaurants)
+    if stream:
+        return stream_llm_response(prompt, ALFRED_SYSTEM_PROMPT, get_database_metadata(all_restaurants), context_role="alfred")
+    return get_llm_response(prompt, ALFRED_SYSTEM_PROMPT, get_database_metadata(all_restaurants))
 
 # Generate restaurant details
-def generate_restaurant_details(restaurant: Dict[str, Any], all_restaurants: List[Dict[str, Any]]) -> str:
-    system_prompt = f"""
-    You are Alfred, an AI assistant for a restaurant booking system in Bengaluru. Create a detailed and enticing description
-    of this restaurant. Focus on what makes it special, its atmosphere, food options, and practical details.
-    
-    IMPORTANT: You have access to exactly {len(all_restaurants)} restaurants in the database. DO NOT claim or imply
-    that you have more restaurants than this number.
-    """
+def generate_restaurant_details(restaurant: Dict[str, Any], all_restaurants: List[Dict[str, Any]], stream: bool = False) -> Union[str, Iterator[str]]:
+    # The reservation history is not part of the description and grows over time
+    details = {k: v for k, v in restaurant.items() if k != "reservations"}
     
     prompt = f"""Please provide detailed information about this restaurant:
-    {json.dumps(restaurant, indent=2)}
+    {_json_dumps(details)}
     
-    Generate a compelling description highlighting its key features, cuisine, location, seating arrangements, and any specialties.
+    Create a detailed and enticing description of this restaurant. Focus on what makes it special, its atmosphere, food options, and practical details.
+    Highlight its key features, cuisine, location, seating arrangements, and any specialties.
     Keep it informative and attractive but factual. (max 200 words)
     """
     
-    return get_llm_response(prompt, system_prompt, all_restaurants)
+    if stream:
+        return stream_llm_response(prompt, ALFRED_SYSTEM_PROMPT, get_database_metadata(all_restaurants), context_role="alfred")
+    return get_llm_response(prompt, ALFRED_SYSTEM_PROMPT, get_database_metadata(all_restaurants))
+
+# Parse "tomorrow at 7 PM" style input without the LLM; None when the input isn't that simple
+def _parse_simple_date_time(user_input: str) -> Optional[datetime.datetime]:
+    if not _date_parser:
+        return None
+    words = [w.strip(".,!?") for w in user_input.lower().split()]
+    time_words = [w for w in words if _TIME_TOKEN_RE.match(w)]
+    if len(time_words) != 1 or any(w not in _SIMPLE_DATE_WORDS for w in words if w not in time_words):
+        return None
+    
+    date_data = _date_parser.get_date_data(user_input)
+    if not date_data.date_obj or date_data.period != 'time':
+        return None
+    # A relative day or weekday is never more than a week away
+    days_ahead = (date_data.date_obj.date() - datetime.date.today()).days
+    if not 0 <= days_ahead <= 7:
+        return None
+    return date_data.date_obj.replace(second=0, microsecond=0, tzinfo=None)
 
 # Modified parse_date_time function with correct weekday calculation
 def parse_date_time(user_input: str) -> Tuple[Optional[datetime.datetime], str]:
@@ -277,16 +808,17 @@ def parse_date_time(user_input: str) -> Tuple[Optional[datetime.datetime], str]:
     Don't include any other text in your response. Only return valid JSON.
     """
     
+    # Plain expressions like "tomorrow at 7 PM" are parsed locally
+    dt = _parse_simple_date_time(user_input)
+    if dt:
+        return dt, ""
+    
     prompt = f"Extract date and time from: '{user_input}'"
-    response = get_llm_response(prompt, system_prompt)
+    response = get_llm_response(prompt, system_prompt, format="json", options=EXTRACTOR_OPTIONS)
     
     try:
-        # Try to extract JSON from the response
-        match = re.search(r'\{.*\}', response, re.DOTALL)
-        if match:
-            json_str = match.group(0)
-            parsed = json.loads(json_str)
-            
+        parsed = _first_json_object(response)
+        if parsed is not None:
             if parsed.get('date') and parsed.get('time') and parsed['date'] != "null" and parsed['time'] != "null":
                 dt_string = f"{parsed['date']} {parsed['time']}"
                 try:
@@ -326,16 +858,18 @@ def parse_party_size(user_input: str) -> Tuple[Optional[int], str]:
     Don't include any other text in your response. Only return valid JSON.
     """
     
+    # Most answers contain just the number ("4 people", "a table for two"). With more than one
+    # ("two at 8", "2 adults and 2 kids") the LLM decides which is the party size.
+    numbers = [int(m) for m in _NUM_RE.findall(user_input)] + [_WORD2NUM[m.lower()] for m in _WORD_RE.findall(user_input)]
+    if len(numbers) == 1 and numbers[0] > 0:
+        return numbers[0], ""
+    
     prompt = f"Extract party size from: '{user_input}'"
-    response = get_llm_response(prompt, system_prompt)
+    response = get_llm_response(prompt, system_prompt, format="json", options=EXTRACTOR_OPTIONS)
     
     try:
-        # Try to extract JSON from the response
-        match = re.search(r'\{.*\}', response, re.DOTALL)
-        if match:
-            json_str = match.group(0)
-            parsed = json.loads(json_str)
-            
+        parsed = _first_json_object(response)
+        if parsed is not None:
             if parsed.get('party_size') and parsed['party_size'] != "null":
                 return int(parsed['party_size']), ""
             else:
@@ -345,48 +879,155 @@ def parse_party_size(user_input: str) -> Tuple[Optional[int], str]:
     except:
         return None, "I'm having trouble understanding the party size. Please tell me how many people will be dining."
 
-# Add reservation to database
-def add_reservation(restaurants, restaurant_id, name, datetime_obj, party_size):
-    for restaurant in restaurants:
-        if restaurant['id'] == restaurant_id:
-            reservation_id = len(restaurant['reservations']) + 1
+# Set the reservation time along with its display text, which the later prompts reuse
+def set_reservation_datetime(datetime_obj: datetime.datetime):
+    st.session_state.reservation_info["datetime"] = datetime_obj
+    st.session_state.reservation_info["datetime_str"] = datetime_obj.strftime(DATETIME_DISPLAY_FORMAT)
+
+# Summary of the collected reservation details, asking the user to confirm
+def format_confirmation(restaurant_name: str, reservation_info: Dict[str, Any]) -> str:
+    return f"Let me confirm your reservation:\n\nName: {reservation_info['name']}\nRestaurant: {restaurant_name}\nDate & Time: {reservation_info['datetime_str']}\nParty Size: {reservation_info['party_size']} people\n\nIs this information correct? (yes/no)"
+
+# Tell the user which queued reservation could not be saved
+def format_save_error(item: Dict[str, Any], restaurants) -> str:
+    restaurant = get_restaurants_by_id(restaurants).get(item["restaurant_id"], {"name": "the restaurant"})
+    return _RESP_SAVE_ERROR.format(restaurant=restaurant["name"], datetime_str=item["datetime"].strftime(DATETIME_DISPLAY_FORMAT))
+
+# Add queued reservations to the database with a single save; returns the items that could not be added
+def add_reservations_bulk(restaurants, items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    by_id = build_restaurants_by_id(restaurants)
+    failed = []
+    for item in items:
+        restaurant = by_id.get(item.get("restaurant_id"))
+        if restaurant is None:
+            failed.append(item)
+            continue
+        # A malformed item only fails itself, not the other reservations in the batch
+        try:
             reservation = {
-                "id": reservation_id,
-                "name": name,
-                "datetime": datetime_obj.strftime("%Y-%m-%d %H:%M"),
-                "party_size": party_size,
+                "id": len(restaurant['reservations']) + 1,
+                "name": item["name"],
+                "datetime": item["datetime"].strftime("%Y-%m-%d %H:%M"),
+                "party_size": item["party_size"],
                 "status": "confirmed"
             }
-            restaurant['reservations'].append(reservation)
-            save_database(restaurants)
-            return True, reservation
-    return False, None
+        except (KeyError, AttributeError, TypeError, ValueError):
+            failed.append(item)
+            continue
+        restaurant['reservations'].append(reservation)
+    if len(failed) < len(items):
+        save_database(restaurants)
+    return failed
+
+# Background thread that saves confirmed reservations in batches, off the response path.
+# Every run and session shares one writer, so it is the only code that writes reservations.
+class ReservationWriter:
+    def __init__(self, batch_size: int = RESERVATION_BATCH_SIZE, flush_interval: float = RESERVATION_FLUSH_INTERVAL):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending_reservations: "queue.Queue[Dict[str, Any]]" = queue.Queue()
+        # session key -> reservations that could not be saved, until that session picks them up
+        self._failures: Dict[str, List[Dict[str, Any]]] = {}
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="reservation-writer", daemon=True)
+        self._thread.start()
+        # Users are told "confirmed" before the save, so whatever is still queued is written on shutdown
+        atexit.register(self.close)
+    
+    def submit(self, item: Dict[str, Any]):
+        self._pending_reservations.put(item)
+    
+    def take_failures(self, session_key: str) -> List[Dict[str, Any]]:
+        with self._lock:
+            return self._failures.pop(session_key, [])
+    
+    # Stop the writer once everything queued so far has been saved
+    def close(self, timeout: float = 10.0):
+        if self._thread.is_alive():
+            self._pending_reservations.put(None)
+            self._thread.join(timeout)
+    
+    # Wait for one reservation, then gather more until the batch is full or the interval ends.
+    # Also reports whether the stop marker from close() was reached.
+    def _next_batch(self) -> Tuple[List[Dict[str, Any]], bool]:
+        batch = []
+        deadline = None
+        while len(batch) < self.batch_size:
+            try:
+                if deadline is None:
+                    item = self._pending_reservations.get()
+                    deadline = time.monotonic() + self.flush_interval
+                else:
+                    item = self._pending_reservations.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+    
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch, stopping = self._next_batch()
+            if not batch:
+                continue
+            try:
+                # Read the file fresh so reservations made by other sessions are kept
+                failed = add_reservations_bulk(load_database(), batch)
+            except Exception:
+                failed = batch
+            if failed:
+                with self._lock:
+                    for item in failed:
+                        self._failures.setdefault(item["session"], []).append(item)
+
+@st.cache_resource
+def _get_reservation_writer() -> ReservationWriter:
+    return ReservationWriter()
+
+# Queue a confirmed reservation for the background writer
+def queue_reservation(restaurant_id, name, datetime_obj, party_size):
+    _get_reservation_writer().submit({
+        "session": st.session_state.session_key,
+        "restaurant_id": restaurant_id,
+        "name": name,
+        "datetime": datetime_obj,
+        "party_size": party_size
+    })
 
 # Generate a normal conversation response
-def generate_conversation_response(user_input: str, chat_history: List[Dict[str, str]], restaurants: List[Dict[str, Any]]) -> str:
-    system_prompt = f"""
-    You are Alfred, a friendly AI assistant for a restaurant booking system in Bengaluru.
-    Respond to the user in a helpful, concise, and conversational way. If they're asking about restaurants 
-    or reservations, guide them toward using those features of the system.
-    
-    IMPORTANT: You have access to exactly {len(restaurants)} restaurants in the database. DO NOT claim or imply
-    that you have more restaurants than this number. Only reference the actual number of available restaurants.
-    
-    Keep your response under 100 words unless you need to provide detailed information.
-    """
-    
+def generate_conversation_response(user_input: str, chat_history: List[Tuple[str, str]], restaurants: List[Dict[str, Any]], stream: bool = False) -> Union[str, Iterator[str]]:
     # Create a formatted chat history for context
-    history_text = "\n".join([f"User: {msg['user']}\nAssistant: {msg['assistant']}" for msg in chat_history[-3:]])
+    history_text = "\n".join([f"User: {user_msg}\nAssistant: {assistant_msg}" for user_msg, assistant_msg in chat_history[-3:]])
     
     prompt = f"""Recent conversation:
     {history_text}
     
     User: {user_input}
     
-    Please provide a helpful response as the restaurant booking assistant:
+    Please provide a helpful response as the restaurant booking assistant. If they're asking about restaurants
+    or reservations, guide them toward using those features of the system.
+    Keep your response under 100 words unless you need to provide detailed information.
     """
     
-    return get_llm_response(prompt, system_prompt, restaurants)
+    if stream:
+        return stream_llm_response(prompt, ALFRED_SYSTEM_PROMPT, get_database_metadata(restaurants), context_role="alfred")
+    return get_llm_response(prompt, ALFRED_SYSTEM_PROMPT, get_database_metadata(restaurants))
+
+# Match a restaurant by name without the LLM: a full-name mention, or the candidate sharing the most name words
+def match_restaurant_by_name(user_input: str, candidates: List[Dict[str, Any]], name_tokens: Dict[int, set]) -> Optional[int]:
+    text, input_tokens = _normalize_input(user_input)
+    
+    best_id, best_score = None, 0
+    for r in candidates:
+        if r["name"].lower() in text:
+            return r["id"]
+        score = len(input_tokens & name_tokens.get(r["id"], set()))
+        if score > best_score:
+            best_id, best_score = r["id"], score
+    
+    return best_id if best_score >= NAME_MATCH_MIN_TOKENS else None
 
 # Enhanced restaurant matching using LLM
 def match_restaurant_from_input(user_input, available_restaurants, all_restaurants):
@@ -409,50 +1050,72 @@ def match_restaurant_from_input(user_input, available_restaurants, all_restauran
     Which restaurant is the user referring to?
     """
     
-    response = get_llm_response(prompt, system_prompt, all_restaurants)
+    response = get_llm_response(prompt, system_prompt, get_database_metadata(all_restaurants), format="json", options=EXTRACTOR_OPTIONS)
     
-    try:
-        match = re.search(r'\{.*\}', response, re.DOTALL)
-        if match:
-            json_str = match.group(0)
-            parsed = json.loads(json_str)
-            return parsed.get('restaurant_id')
-    except:
-        pass
-    
-    return None
+    parsed = _first_json_object(response) or {}
+    return parsed.get('restaurant_id')
 
-# Enhanced intent detection with context
-def detect_intent_with_context(user_input, context=None, restaurants=None):
+# Extract intent, restaurant and reservation details from one user turn in a single LLM call
+def extract_turn(user_input: str, state: State, restaurants: List[Dict[str, Any]]) -> Dict[str, Any]:
     system_prompt = f"""
-    You are an AI assistant for a restaurant booking system. Analyze the user input and determine their intent.
-    Consider any context provided. 
-    
-    IMPORTANT: You have access to exactly {len(restaurants)} restaurants in the database. DO NOT claim or imply
-    that you have more restaurants than this number.
+    You are an AI assistant for a restaurant booking system. Extract everything the user said in this turn.
+    The conversation is currently in the '{state.name}' step.
+    Today's date is {datetime.date.today().isoformat()}.
     
-    Return ONLY a JSON object with:
+    Return ONLY a JSON object with these fields, using null for anything the user did not mention:
     {{
         "intent": "restaurant_search" or "reservation" or "details" or "normal_conversation",
-        "confidence": "high" or "medium" or "low",
-        "restaurant_id": number or null (if they're referring to a specific restaurant)
+        "restaurant_id": number or null (if they're referring to one of the listed restaurants),
+        "date": "YYYY-MM-DD" or null,
+        "time": "HH:MM" or null,
+        "party_size": number or null
     }}
     """
     
-    context_str = f"Context: {context}\n\n" if context else ""
-    prompt = f"{context_str}Determine the intent from this user input: '{user_input}'"
+    prompt = f"""
+    User message: '{user_input}'
+    Available restaurants: {json.dumps([{'id': r['id'], 'name': r['name']} for r in restaurants])}
+    """
+    
+    # Five fields need a little more room than the single-purpose extractors
+    response = get_llm_response(prompt, system_prompt, format="json", options={**EXTRACTOR_OPTIONS, "num_predict": 128})
+    parsed = _first_json_object(response) or {}
     
-    response = get_llm_response(prompt, system_prompt, restaurants)
+    turn = {
+        "intent": parsed.get("intent") or "normal_conversation",
+        "restaurant_id": parsed.get("restaurant_id"),
+        "datetime": None,
+        "party_size": None
+    }
+    
+    # Only keep reservation details that parse cleanly
+    if parsed.get("date") and parsed.get("time") and parsed["date"] != "null" and parsed["time"] != "null":
+        try:
+            turn["datetime"] = datetime.datetime.strptime(f"{parsed['date']} {parsed['time']}", "%Y-%m-%d %H:%M")
+        except (TypeError, ValueError):
+            pass
     
     try:
-        match = re.search(r'\{.*\}', response, re.DOTALL)
-        if match:
-            json_str = match.group(0)
-            return json.loads(json_str)
-    except:
-        # Fallback
-        return {"intent": "normal_conversation", "confidence": "low", "restaurant_id": None}
+        if parsed.get("party_size") and parsed["party_size"] != "null":
+            turn["party_size"] = int(parsed["party_size"])
+    except (TypeError, ValueError):
+        pass
+    
+    return turn
+
 
+# Display an assistant response, rendering streamed responses as they arrive, and return the full text
+def render_response(response: Union[str, Iterator[str]]) -> str:
+    if isinstance(response, str):
+        st.write(response)
+        return response
+    
+    placeholder = st.empty()
+    text = ""
+    for chunk in response:
+        text += chunk
+        placeholder.markdown(text)
+    return text
 
 # Modified main function to prevent duplicate processing
 def main():
@@ -477,15 +1140,31 @@ def main():
         st.session_state.reservation_info = {
             "name": None,
             "datetime": None,
+            "datetime_str": None,
             "party_size": None
         }
     if 'filtered_restaurants' not in st.session_state:
         st.session_state.filtered_restaurants = []
     if 'last_processed_input' not in st.session_state:
         st.session_state.last_processed_input = None
+    if 'paired_history' not in st.session_state:
+        st.session_state.paired_history = []
+    if 'prefilled' not in st.session_state:
+        st.session_state.prefilled = {"datetime": None, "party_size": None}
+    if 'session_key' not in st.session_state:
+        st.session_state.session_key = uuid.uuid4().hex
     
     # Load database
-    restaurants = load_database()
+    restaurants = get_restaurants()
+    
+    # Reservations the background writer could not save switch the conversation to error handling.
+    # The failure is only noticed on the next run, so it answers the next input instead of that
+    # input being taken as the reply to a question the user hasn't seen yet.
+    failed = _get_reservation_writer().take_failures(st.session_state.session_key)
+    if failed:
+        st.session_state.pending_errors = st.session_state.get("pending_errors", []) + failed
+        st.session_state.state = State.ERROR_HANDLING
+        st.session_state.save_error_notice = format_save_error(failed[-1], restaurants)
     
     # App title
     st.title("Alfred 🍽️")
@@ -498,7 +1177,7 @@ def main():
     
     # Initial greeting
     if st.session_state.state == State.GREETING and not st.session_state.chat_history:
-        greeting = "Hello! I'm Alfred, your Bengaluru restaurant assistant. I can help you find restaurants and make reservations. What are you looking for today?"
+        greeting = _RESP_GREETING
         st.session_state.chat_history.append({"role": "assistant", "content": greeting})
         st.session_state.state = State.INTENT_DETECTION
         with st.chat_message("assistant"):
@@ -519,233 +1198,328 @@ def main():
             # Add to chat history
             st.session_state.chat_history.append({"role": "user", "content": user_input})
             
-            # Process based on current state
-            response = process_state(user_input, restaurants)
+            # Process based on current state, unless a failed save has to be reported first
+            response = st.session_state.pop('save_error_notice', None) or process_state(user_input, restaurants)
             
             # Display assistant response
             with st.chat_message("assistant"):
-                st.write(response)
+                response = render_response(response)
             
             # Add to chat history
             st.session_state.chat_history.append({"role": "assistant", "content": response})
+            
+            # Keep the completed (user, assistant) exchange for conversation prompts, bounded in length
+            st.session_state.paired_history.append((user_input, response))
+            if len(st.session_state.paired_history) > PAIRED_HISTORY_LIMIT:
+                del st.session_state.paired_history[:-PAIRED_HISTORY_LIMIT]
 
-# Modified process_state function to prevent duplicate state processing
-def process_state(user_input, restaurants):
-    current_state = st.session_state.state
-    next_state = None
+# Intent detection state
+def _handle_intent_detection(user_input, restaurants):
     response = None
     
-    # Intent detection state
-    if current_state == State.INTENT_DETECTION:
-        intent = detect_intent(user_input)
-        
-        if intent == 'restaurant_search':
+    intent, search_params = detect_intent_with_search_params(user_input, restaurants)
+    
+    if intent == 'restaurant_search':
+        next_state = State.FIND_RESTAURANT
+        # Hand the already extracted parameters to the search state
+        st.session_state.prefetched_params = (user_input, search_params)
+        # Don't process again immediately
+    
+    elif intent == 'reservation':
+        if st.session_state.current_restaurant_id:
+            next_state = State.NAME_PROMPT
+            response = _RESP_START_BOOKING
+        else:
             next_state = State.FIND_RESTAURANT
+            response = _RESP_FIND_FIRST
+    
+    elif intent == 'details':
+        if st.session_state.current_restaurant_id:
+            next_state = State.RESTAURANT_DETAILS
             # Don't process again immediately
-        
-        elif intent == 'reservation':
-            if st.session_state.current_restaurant_id:
-                next_state = State.MAKE_RESERVATION
-                response = "Great! Let's make a reservation. Under what name should I make the reservation?"
-            else:
-                next_state = State.FIND_RESTAURANT
-                response = "I'd be happy to help you make a reservation. First, let's find a restaurant. Do you have any preferences for cuisine, location, or price range?"
-        
-        elif intent == 'details':
-            if st.session_state.current_restaurant_id:
-                next_state = State.RESTAURANT_DETAILS
-                # Don't process again immediately
-            else:
-                next_state = State.FIND_RESTAURANT
-                response = "I'd be happy to provide details about a restaurant. Which restaurant are you interested in?"
-        
-        else:  # normal_conversation
-            next_state = State.NORMAL_CONVERSATION
-            response = generate_conversation_response(user_input, [
-                {"user": msg["content"], "assistant": st.session_state.chat_history[i+1]["content"]} 
-                for i, msg in enumerate(st.session_state.chat_history[:-1:2])
-            ], restaurants)
-    
-    # Find restaurant state
-    elif current_state == State.FIND_RESTAURANT:
-        search_params = extract_search_params(user_input)
-        filtered = find_restaurants(search_params, restaurants)
-        
-        st.session_state.filtered_restaurants = filtered
-        next_state = State.RESTAURANT_SUGGESTION
-        
-        response = generate_restaurant_suggestions(filtered, restaurants)
-    
-    # Restaurant suggestion state
-    elif current_state == State.RESTAURANT_SUGGESTION:
-        # First try a simple direct name match
-        restaurant_id = None
-        for r in st.session_state.filtered_restaurants:
-            if r["name"].lower() in user_input.lower():
-                restaurant_id = r["id"]
-                break
-        
-        # If direct match doesn't work, use the context-based matching
-        if not restaurant_id:
-            context = {
-                "recent_suggestions": [r["name"] for r in st.session_state.filtered_restaurants],
-                "last_message": st.session_state.chat_history[-2]["content"] if len(st.session_state.chat_history) > 1 else ""
-            }
-            
-            # Let the LLM detect intent with context
-            intent_data = detect_intent_with_context(user_input, json.dumps(context), restaurants)
-            restaurant_id = intent_data.get("restaurant_id")
-        
-        # If we found a restaurant match
-        if restaurant_id:
-            st.session_state.current_restaurant_id = restaurant_id
-            restaurant = next((r for r in restaurants if r["id"] == st.session_state.current_restaurant_id), None)
-            
-            if "reserv" in user_input.lower() or "book" in user_input.lower():
-                next_state = State.MAKE_RESERVATION
-                response = f"Great! I'll make a reservation at {restaurant['name']} for you. Under what name should I make the reservation?"
-            else:
-                next_state = State.RESTAURANT_DETAILS
-                response = generate_restaurant_details(restaurant, restaurants)
-        
-        # If no match but reservation intent
-        elif "reserv" in user_input.lower() or "book" in user_input.lower():
-            response = "Which of these restaurants would you like to make a reservation for? Please specify the restaurant name clearly."
-            # Stay in the same state
-        
-        # Otherwise continue with normal flow
         else:
-            next_state = State.INTENT_DETECTION
-            # Will process in the next cycle
+            next_state = State.FIND_RESTAURANT
+            response = _RESP_WHICH_DETAILS
     
-    # Restaurant details state
-    elif current_state == State.RESTAURANT_DETAILS:
-        # Check if user wants to make a reservation
-        intent = detect_intent(user_input)
-        
-        if 'reserv' in user_input.lower() or 'book' in user_input.lower() or intent == 'reservation':
-            next_state = State.MAKE_RESERVATION
-            response = "Great! I'd be happy to make a reservation for you. Under what name should I make the reservation?"
+    else:  # normal_conversation
+        next_state = State.NORMAL_CONVERSATION
+        response = generate_conversation_response(user_input, st.session_state.paired_history[-3:], restaurants, stream=True)
+    
+    return next_state, response
+
+# Find restaurant state
+def _handle_find_restaurant(user_input, restaurants):
+    prefetched = st.session_state.pop('prefetched_params', None)
+    if prefetched and prefetched[0] == user_input:
+        search_params = prefetched[1]
+    else:
+        search_params = extract_search_params(user_input, restaurants)
+    filtered = find_restaurants(search_params, restaurants)
+    
+    st.session_state.filtered_restaurants = filtered
+    next_state = State.RESTAURANT_SUGGESTION
+    
+    response = generate_restaurant_suggestions(filtered, restaurants, stream=True)
+    
+    return next_state, response
+
+# Restaurant suggestion state
+def _handle_restaurant_suggestion(user_input, restaurants):
+    ss = st.session_state
+    candidates = ss.filtered_restaurants
+    restaurants_by_id = get_restaurants_by_id(restaurants)
+    next_state = None
+    response = None
+    
+    # First try matching the restaurant name directly
+    restaurant_id = match_restaurant_by_name(user_input, candidates, get_name_tokens(restaurants))
+    
+    wants_booking = classify_intent(user_input) == 'reservation'
+    turn = None
+    
+    # One combined call resolves the restaurant and picks up any date, time and party size
+    # given along with a booking request ("book Spice Garden tomorrow 7pm for 4")
+    if not restaurant_id or wants_booking:
+        turn = extract_turn(user_input, State.RESTAURANT_SUGGESTION, candidates)
+        restaurant_id = restaurant_id or turn["restaurant_id"]
+        wants_booking = wants_booking or turn["intent"] == "reservation"
+    
+    # Carry the date, time and party size forward only when this turn books a restaurant, so a
+    # time mentioned in a question ("are any of them open friday at 8pm?") isn't booked later
+    if turn and wants_booking and restaurant_id in restaurants_by_id:
+        ss.prefilled = {"datetime": turn["datetime"], "party_size": turn["party_size"]}
+    else:
+        ss.prefilled = {"datetime": None, "party_size": None}
+    
+    # If we found a restaurant match (ignoring ids the LLM made up)
+    if restaurant_id in restaurants_by_id:
+        ss.current_restaurant_id = restaurant_id
+        restaurant = restaurants_by_id[restaurant_id]
+    
+        if wants_booking:
+            # The reply already asks for the name, so the next input is the name
+            next_state = State.NAME_PROMPT
+            response = f"Great! I'll make a reservation at {restaurant['name']} for you. {_RESP_ASK_NAME}"
         else:
-            # They're satisfied with the information or have another question
-            next_state = State.INTENT_DETECTION
-            # Will process in the next cycle
+            next_state = State.RESTAURANT_DETAILS
+            response = generate_restaurant_details(restaurant, restaurants, stream=True)
+    
+    # If no match but reservation intent
+    elif wants_booking:
+        response = _RESP_WHICH_BOOKING
+        # Stay in the same state
+    
+    # Otherwise continue with normal flow
+    else:
+        next_state = State.INTENT_DETECTION
+        # Will process in the next cycle
+    
+    return next_state, response
+
+# Restaurant details state
+def _handle_restaurant_details(user_input, restaurants):
+    response = None
     
-    # Make reservation state (start data collection)
-    elif current_state == State.MAKE_RESERVATION:
+    # Check if user wants to make a reservation
+    if detect_intent(user_input) == 'reservation':
         next_state = State.NAME_PROMPT
-        response = "Under what name should I make the reservation?"
+        response = _RESP_BOOK_FROM_DETAILS
+    else:
+        # They're satisfied with the information or have another question
+        next_state = State.INTENT_DETECTION
+        # Will process in the next cycle
     
-    # Name prompt state
-    elif current_state == State.NAME_PROMPT:
-        st.session_state.reservation_info["name"] = user_input
+    return next_state, response
+
+# Make reservation state (start data collection)
+def _handle_make_reservation(user_input, restaurants):
+    next_state = State.NAME_PROMPT
+    response = _RESP_ASK_NAME
+    
+    return next_state, response
+
+# Name prompt state
+def _handle_name_prompt(user_input, restaurants):
+    ss = st.session_state
+    rinfo = ss.reservation_info
+    prefilled = ss.prefilled
+    rinfo["name"] = user_input
+    
+    # Skip the date/time and party size prompts for details the user already gave
+    if prefilled["datetime"]:
+        set_reservation_datetime(prefilled["datetime"])
+        prefilled["datetime"] = None
+        if prefilled["party_size"]:
+            rinfo["party_size"] = prefilled["party_size"]
+            prefilled["party_size"] = None
+            next_state = State.CONFIRM_RESERVATION
+            restaurant = get_restaurants_by_id(restaurants).get(ss.current_restaurant_id, {"name": "the restaurant"})
+            response = f"Thank you, {user_input}. {format_confirmation(restaurant['name'], rinfo)}"
+        else:
+            next_state = State.PARTY_PROMPT
+            response = f"Thank you, {user_input}. Reservation for {rinfo['datetime_str']}. How many people will be in your party?"
+    else:
         next_state = State.DATETIME_PROMPT  # Skip the intermediate NAME_RECEIVED state
         response = f"Thank you, {user_input}. When would you like to make your reservation? Please specify the date and time."
     
-    # Datetime prompt state
-    elif current_state == State.DATETIME_PROMPT:
-        datetime_obj, error_msg = parse_date_time(user_input)
-        
-        if datetime_obj:
-            st.session_state.reservation_info["datetime"] = datetime_obj
-            next_state = State.PARTY_PROMPT  # Skip the intermediate DATETIME_RECEIVED state
-            response = f"Got it! Reservation for {datetime_obj.strftime('%A, %B %d at %I:%M %p')}. How many people will be in your party?"
-        else:
-            response = error_msg
-            # Stay in the same state
+    return next_state, response
+
+# Datetime prompt state
+def _handle_datetime_prompt(user_input, restaurants):
+    ss = st.session_state
+    rinfo = ss.reservation_info
+    next_state = None
     
-    # Party prompt state
-    elif current_state == State.PARTY_PROMPT:
-        party_size, error_msg = parse_party_size(user_input)
-        
+    datetime_obj, error_msg = parse_date_time(user_input)
+    
+    if datetime_obj:
+        set_reservation_datetime(datetime_obj)
+        prefilled = ss.prefilled
+        party_size = prefilled["party_size"]
+        prefilled["party_size"] = None
+    
+        # Party size was already given with the booking request
         if party_size:
-            st.session_state.reservation_info["party_size"] = party_size
-            next_state = State.CONFIRM_RESERVATION  # Skip the intermediate PARTY_RECEIVED state
-            
-            # Get restaurant name
-            restaurant = next((r for r in restaurants if r["id"] == st.session_state.current_restaurant_id), {"name": "the restaurant"})
-            
-            response = f"Great! Let me confirm your reservation:\n\nName: {st.session_state.reservation_info['name']}\nRestaurant: {restaurant['name']}\nDate & Time: {st.session_state.reservation_info['datetime'].strftime('%A, %B %d at %I:%M %p')}\nParty Size: {party_size} people\n\nIs this information correct? (yes/no)"
-        else:
-            response = error_msg
-            # Stay in the same state
-    
-    # Confirm reservation state
-    elif current_state == State.CONFIRM_RESERVATION:
-        if 'yes' in user_input.lower() or 'correct' in user_input.lower() or 'confirm' in user_input.lower():
-            next_state = State.RESERVATION_CONFIRMED
-            response = "Thank you for confirming. I'm processing your reservation now..."
+            rinfo["party_size"] = party_size
+            next_state = State.CONFIRM_RESERVATION
+            restaurant = get_restaurants_by_id(restaurants).get(ss.current_restaurant_id, {"name": "the restaurant"})
+            response = f"Got it! {format_confirmation(restaurant['name'], rinfo)}"
         else:
-            next_state = State.MAKE_RESERVATION
-            response = "Let's try again. Under what name should I make the reservation?"
+            next_state = State.PARTY_PROMPT  # Skip the intermediate DATETIME_RECEIVED state
+            response = f"Got it! Reservation for {rinfo['datetime_str']}. How many people will be in your party?"
+    else:
+        response = error_msg
+        # Stay in the same state
     
-    # Reservation confirmed state (transition to database push)
-    elif current_state == State.RESERVATION_CONFIRMED:
-        next_state = State.DATABASE_PUSH
-        
-        success, reservation = add_reservation(
-            restaurants,
-            st.session_state.current_restaurant_id,
-            st.session_state.reservation_info["name"],
-            st.session_state.reservation_info["datetime"],
-            st.session_state.reservation_info["party_size"]
-        )
-        
-        if success:
-            next_state = State.RESERVATION_SUCCESS
-            
-            # Get restaurant name
-            restaurant = next((r for r in restaurants if r["id"] == st.session_state.current_restaurant_id), {"name": "the restaurant"})
-            
-            response = f"Your reservation at {restaurant['name']} has been confirmed! We look forward to serving you on {st.session_state.reservation_info['datetime'].strftime('%A, %B %d at %I:%M %p')}. Is there anything else you would like to know?"
-        else:
-            next_state = State.ERROR_HANDLING
-            response = "I'm sorry, there was an error processing your reservation. Would you like to try again or speak with customer support?"
-    
-    # Error handling state
-    elif current_state == State.ERROR_HANDLING:
-        if 'try' in user_input.lower() or 'again' in user_input.lower():
-            next_state = State.RESERVATION_RETRY
-            response = "Let's try making your reservation again. Under what name should I make the reservation?"
-        else:
-            next_state = State.SUPPORT
-            response = "I'll connect you with customer support. Please call +91 80 12345678 during business hours (9 AM - 6 PM) for assistance with your reservation."
+    return next_state, response
+
+# Party prompt state
+def _handle_party_prompt(user_input, restaurants):
+    next_state = None
     
-    # Reservation retry state
-    elif current_state == State.RESERVATION_RETRY:
-        next_state = State.MAKE_RESERVATION
-        response = "Let's start over with your reservation. Under what name should I make the reservation?"
+    party_size, error_msg = parse_party_size(user_input)
     
-    # Support state
-    elif current_state == State.SUPPORT:
-        next_state = State.INTENT_DETECTION
-        response = "Our customer support team is available to help you. Is there anything else I can assist you with?"
+    if party_size:
+        ss = st.session_state
+        rinfo = ss.reservation_info
+        rinfo["party_size"] = party_size
+        next_state = State.CONFIRM_RESERVATION  # Skip the intermediate PARTY_RECEIVED state
     
-    # Reservation success state
-    elif current_state == State.RESERVATION_SUCCESS:
-        next_state = State.THANK_YOU
-        response = "Thank you for using Alfred! Your reservation has been confirmed. Is there anything else you would like assistance with?"
+        # Get restaurant name
+        restaurant = get_restaurants_by_id(restaurants).get(ss.current_restaurant_id, {"name": "the restaurant"})
     
-    # Thank you state
-    elif current_state == State.THANK_YOU:
-        next_state = State.INTENT_DETECTION
-        # Will process in the next cycle
+        response = f"Great! {format_confirmation(restaurant['name'], rinfo)}"
+    else:
+        response = error_msg
+        # Stay in the same state
     
-    # Normal conversation state
-    elif current_state == State.NORMAL_CONVERSATION:
-        next_state = State.INTENT_DETECTION
-        # Will process in the next cycle
+    return next_state, response
+
+# Confirm reservation state
+def _handle_confirm_reservation(user_input, restaurants):
+    if CONFIRM_TRIGGERS & _normalize_input(user_input)[1]:
+        next_state = State.RESERVATION_CONFIRMED
+        response = _RESP_CONFIRMING
+    else:
+        next_state = State.NAME_PROMPT
+        response = _RESP_NOT_CONFIRMED
     
-    # Update the state if a new state was set
-    if next_state:
-        st.session_state.state = next_state
+    return next_state, response
+
+# Reservation confirmed state (queue the reservation for the database writer)
+def _handle_reservation_confirmed(user_input, restaurants):
+    ss = st.session_state
+    rinfo = ss.reservation_info
+    rid = ss.current_restaurant_id
+    restaurant = get_restaurants_by_id(restaurants).get(rid)
+    if restaurant is None:
+        next_state = State.ERROR_HANDLING
+        response = _RESP_ERROR
+        return next_state, response
+    
+    # Confirm right away; if the background save fails, main() reports it on a later run
+    queue_reservation(rid, rinfo["name"], rinfo["datetime"], rinfo["party_size"])
+    next_state = State.RESERVATION_SUCCESS
+    
+    response = f"Your reservation at {restaurant['name']} has been confirmed! We look forward to serving you on {rinfo['datetime_str']}. Is there anything else you would like to know?"
+    
+    return next_state, response
+
+# Error handling state
+def _handle_error_handling(user_input, restaurants):
+    ss = st.session_state
+    # The user is dealing with any failed background saves now
+    failed = ss.get("pending_errors") or []
+    ss.pending_errors = []
+    if TRY_TRIGGERS & _normalize_input(user_input)[1]:
+        # Retry the failed booking with its restaurant, time and party size, so only the name is asked again
+        if failed:
+            ss.current_restaurant_id = failed[-1]["restaurant_id"]
+            ss.prefilled = {"datetime": failed[-1]["datetime"], "party_size": failed[-1]["party_size"]}
+        # The reply already asks for the name, so the next input is the name
+        next_state = State.NAME_PROMPT
+        response = _RESP_TRY_AGAIN
+    else:
+        next_state = State.SUPPORT
+        response = _RESP_SUPPORT
+    
+    return next_state, response
+
+# Support state
+def _handle_support(user_input, restaurants):
+    next_state = State.INTENT_DETECTION
+    response = _RESP_SUPPORT_FOLLOW_UP
+    
+    return next_state, response
+
+# Reservation success state
+def _handle_reservation_success(user_input, restaurants):
+    next_state = State.THANK_YOU
+    response = _RESP_THANK_YOU
+    
+    return next_state, response
+
+# Handler for each conversation state, built once at import time
+_HANDLERS = {
+    State.INTENT_DETECTION: _handle_intent_detection,
+    State.FIND_RESTAURANT: _handle_find_restaurant,
+    State.RESTAURANT_SUGGESTION: _handle_restaurant_suggestion,
+    State.RESTAURANT_DETAILS: _handle_restaurant_details,
+    State.MAKE_RESERVATION: _handle_make_reservation,
+    State.NAME_PROMPT: _handle_name_prompt,
+    State.DATETIME_PROMPT: _handle_datetime_prompt,
+    State.PARTY_PROMPT: _handle_party_prompt,
+    State.CONFIRM_RESERVATION: _handle_confirm_reservation,
+    State.RESERVATION_CONFIRMED: _handle_reservation_confirmed,
+    State.ERROR_HANDLING: _handle_error_handling,
+    State.SUPPORT: _handle_support,
+    State.RESERVATION_SUCCESS: _handle_reservation_success
+}
+
+# States that only mark the end of an exchange; the next input goes straight to intent detection
+_PASSTHROUGH = frozenset({State.THANK_YOU, State.NORMAL_CONVERSATION})
+
+# Modified process_state function to prevent duplicate state processing
+def process_state(user_input, restaurants):
+    current_state = st.session_state.state
+    
+    # States that produce no response hand the same input on to the next state until one answers
+    for _ in range(MAX_STATE_TRANSITIONS):
+        if current_state in _PASSTHROUGH:
+            current_state = State.INTENT_DETECTION
+        handler = _HANDLERS.get(current_state)
+        next_state, response = handler(user_input, restaurants) if handler else (None, None)
+        
+        # Stop once we have a response or the state didn't change; otherwise process the new state
+        if response is not None or not next_state or next_state == current_state:
+            break
+        current_state = next_state
     
-    # If we don't have a response yet and we've changed state, process the new state
-    if response is None and next_state and next_state != current_state:
-        return process_state(user_input, restaurants)
+    # Update the state once, after the last transition
+    st.session_state.state = next_state or current_state
     
     # Return the response
-    return response or "I'm not sure what you're looking for. Would you like to search for restaurants or make a reservation?"
+    return response or _RESP_FALLBACK
 
 if __name__ == "__main__":
     main()